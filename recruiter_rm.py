@@ -4,141 +4,765 @@ recruiter_rm: Recruiter Relationship Manager
 Automatically responds to recruiter's emails with a courtesy message.
 """
 
+import contextlib
+import functools
+import hashlib
+import itertools
 import json
 import os
+import queue
 import re
 import smtplib
+import struct
 import sys
+import tempfile
 import textwrap
+import threading
 import time
 import traceback
 
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from imap_tools import MailBox, MailMessage, MailMessageFlags
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+from imap_tools import H, NOT, EmailAddress, MailBox, MailMessage, MailMessageFlags
+from imap_tools.errors import MailboxFetchError, MailboxUidsError
+from imap_tools.utils import check_command_status
 
-import openai
+import numpy as np
 
 
 # TODO configuration file?
 DRY_RUN = bool(int(os.getenv("DRY_RUN", "1")))
 BYPASS_OPENAI = bool(int(os.getenv("BYPASS_OPENAI", "0")))
 SIGNATURE = os.getenv("SIGNATURE")
+EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS")
+MAILBOX_RECRUITMENT_FOLDER = os.getenv("MAILBOX_RECRUITMENT_FOLDER")
+MAILBOX_SENT_FOLDER = os.getenv("MAILBOX_SENT_FOLDER")
+MAILBOX_DONE_FOLDER = os.getenv("MAILBOX_DONE_FOLDER")
 GRACE_PERIOD_SECS = 5
+WORKERS = int(os.getenv("WORKERS", "8"))
+EXTRACTION_BATCH_SIZE = int(os.getenv("EXTRACTION_BATCH_SIZE", "10"))
+IMAP_BULK = int(os.getenv("IMAP_BULK", "100"))
+CACHE_DIR = os.getenv("CACHE_DIR", ".recruiter_rm_cache")
+MODEL = "gpt-4o-mini"
+# bump whenever the prompt changes so stale cached parses are not reused
+PROMPT_VERSION = "4"
+NAMES_AND_COMPANIES_SCHEMA = {
+    "name": "NameCoBatch",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "email": {"type": "integer"},
+                        "name": {"type": ["string", "null"]},
+                        "company": {"type": ["string", "null"]},
+                    },
+                    "required": ["email", "name", "company"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["results"],
+        "additionalProperties": False,
+    },
+}
+MAX_EXTRACTION_RETRIES = 2
+# the recruiter's name and company are near the top; anything past this is
+# just paying for prompt tokens
+MAX_PROMPT_EMAIL_CHARS = 1500
+QUOTED_HISTORY_RE = re.compile(
+    r"^(?:On .* wrote:|-+ ?Original Message ?-+)\s*$", re.MULTILINE | re.IGNORECASE
+)
+# a possessive like "This is Acme's talent team" names the company, not a person
+RECRUITER_NAME_RE = re.compile(
+    r"\b(?:I[’' ]m|This is|My name is)\s+([A-Z][a-z]+)\b(?![’']s\b)"
+)
+RECRUITER_COMPANY_RE = re.compile(
+    r"\b(?:with|at|from|recruiter (?:at|for))\s+([A-Z][\w&.\-]*(?: [A-Z][\w&.\-]*){0,4})"
+)
+# capitalized words that follow "I'm"/"This is" without being a name, e.g. in
+# "I'm Excited to share..."
+NAME_STOPWORDS = {
+    "A",
+    "Also",
+    "An",
+    "Currently",
+    "Delighted",
+    "Eager",
+    "Excited",
+    "Following",
+    "Glad",
+    "Happy",
+    "Here",
+    "Hiring",
+    "Hoping",
+    "Interested",
+    "Just",
+    "Looking",
+    "My",
+    "Not",
+    "Our",
+    "Pleased",
+    "Reaching",
+    "Recruiting",
+    "Sure",
+    "The",
+    "Thrilled",
+    "Working",
+    "Writing",
+    "Your",
+}
+SENTENCE_END_RE = re.compile(r"[.!?](?:\s|$)")
+# company suffixes whose trailing period doesn't end the sentence
+COMPANY_SUFFIXES = {"Co.", "Corp.", "Inc.", "LLC.", "Ltd."}
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+# Only the headers needed to reply to and decode a message, plus its body, are
+# fetched; the MIME headers are needed to decode the body.
+RECRUITER_EMAIL_FETCH_PARTS = (
+    "(UID BODY.PEEK[HEADER.FIELDS (FROM SUBJECT MESSAGE-ID IN-REPLY-TO MIME-VERSION"
+    " CONTENT-TYPE CONTENT-TRANSFER-ENCODING)] BODY.PEEK[TEXT])"
+)
+FETCH_RESPONSE_START_RE = re.compile(rb"^\d+ \(")
+# mail from these domains says nothing about the recruiter's company, either
+# because anyone can sign up or because they relay mail for applicant tracking
+# second-level labels under a country code, e.g. the "co" in acme.co.uk
+SECOND_LEVEL_DOMAINS = {"ac", "co", "com", "edu", "gov", "ltd", "net", "org", "plc"}
+HONORIFICS = {"dr", "miss", "mr", "mrs", "ms", "mx", "prof"}
+GENERIC_EMAIL_DOMAINS = {
+    "aol",
+    "ashbyhq",
+    "fastmail",
+    "gmail",
+    "gmx",
+    "googlemail",
+    "greenhouse",
+    "hotmail",
+    "icloud",
+    "indeed",
+    "lever",
+    "linkedin",
+    "live",
+    "mail",
+    "me",
+    "msn",
+    "myworkday",
+    "outlook",
+    "proton",
+    "protonmail",
+    "smartrecruiters",
+    "workday",
+    "yahoo",
+    "yandex",
+    "ziprecruiter",
+    "zoho",
+}
+# display names containing these belong to a team or a system, not a person
+GENERIC_SENDER_NAME_WORDS = {
+    "careers",
+    "hiring",
+    "hr",
+    "jobs",
+    "noreply",
+    "notifications",
+    "people",
+    "recruiting",
+    "recruitment",
+    "reply",
+    "talent",
+    "team",
+}
+
+EXTRACTION_PROMPT_TEMPLATE = textwrap.dedent(
+    """
+    Given numbered emails from recruiters, return each recruiter's first name and the recruiter's company's name formatted as valid JSON, with one result per email.
+
+    Example: ***
+    Email [1]:
+    '''
+    Hi Matt! This is Steve Jobs with Apple Computer Company! I'm interested in having you join our team here.
+    '''
+
+    Response:
+    {{"results": [{{"email": 1, "name": "Steve", "company": "Apple Computer Company"}}]}}
+    ***
+
+    {emails}
+    Response:
+    """
+)
+
+RESPONSE_TEMPLATE = textwrap.dedent(
+    """\
+    Hi {name},
+
+    Thanks for reaching out! I'm not interested in new opportunities at this time, but I'll keep {company} in mind for the future.
+
+
+    Thanks again,
+    {signature}
+
+    """
+)
+
+
+@functools.lru_cache(maxsize=None)
+def openai_client():
+    """Creates the OpenAI client on first use. The SDK is slow to import, so
+    it's only imported when a request actually needs to be made."""
+    import openai  # pylint: disable=import-outside-toplevel
+
+    return openai.OpenAI(
+        organization=os.getenv("OPENAI_ORG"), api_key=os.getenv("OPENAI_SECRET_KEY")
+    )
+
+
+class ExtractionCache:
+    """Content-addressable on-disk cache of recruiter name/company parses,
+    keyed by model, prompt version and email text."""
+
+    REQUIRED_KEYS = {"name", "company"}
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts: str):
+        """Hashes the parts, length-prefixing each so that distinct inputs
+        can't collide by shifting bytes between adjacent parts."""
+        digest = hashlib.sha256()
+        for part in parts:
+            encoded = part.encode()
+            digest.update(struct.pack(">Q", len(encoded)))
+            digest.update(encoded)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        """Returns the cached parse for key, or None on a miss. Unreadable or
+        stale entries are evicted."""
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as cache_file:
+                entry = json.load(cache_file)
+            meta = entry["meta"]
+            response = entry["response"]
+            if meta["model"] != MODEL or meta["prompt_version"] != PROMPT_VERSION:
+                raise ValueError("stale cache entry")
+            if not self.REQUIRED_KEYS <= response.keys():
+                raise ValueError("cache entry missing required keys")
+            return response
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            print(f"Evicting invalid cache entry {path}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def put(self, key, response):
+        """Atomically writes a parse to the cache."""
+        entry = {
+            "meta": {"model": MODEL, "prompt_version": PROMPT_VERSION},
+            "response": response,
+            "ts": time.time(),
+        }
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.cache_dir, suffix=".tmp", delete=False, encoding="utf-8"
+        ) as tmp_file:
+            json.dump(entry, tmp_file)
+        os.replace(tmp_file.name, self._path(key))
+
+
+class SemanticCache:
+    """Cache of recruiter name/company parses looked up by embedding cosine
+    similarity, so that lightly-personalized template emails reuse the parse
+    of an earlier variant."""
+
+    def __init__(self, cache_dir, threshold):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.embeddings_path = os.path.join(cache_dir, "embeddings.npy")
+        self.meta_path = os.path.join(cache_dir, "meta.jsonl")
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # a corrupt cache only costs some OpenAI calls, so don't fail the run
+        try:
+            rows, embeddings = self._load()
+            unreadable = False
+        except (OSError, EOFError, ValueError) as exception:
+            print(f"Could not load the semantic cache ({exception}); starting empty")
+            rows, embeddings = [], np.zeros((0, 0), dtype=np.float32)
+            unreadable = True
+
+        # An interrupted write can leave one file a row ahead of the other, and
+        # rows from another model or prompt version are stale. Keep the rest.
+        stored_rows = len(rows)
+        rows = rows[: len(embeddings)]
+        keep = [index for index, row in enumerate(rows) if row is not None]
+        self.meta = [rows[index] for index in keep]
+        self.embeddings = embeddings[keep] if keep else np.zeros((0, 0), np.float32)
+
+        if unreadable or len(keep) != len(embeddings) or len(keep) != stored_rows:
+            print("Dropping stale or invalid semantic cache entries")
+            self._rewrite()
+
+    def _load(self):
+        """Reads the stored rows, parsed with _parse_row, and embeddings."""
+        rows = []
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, encoding="utf-8") as meta_file:
+                rows = [self._parse_row(line) for line in meta_file if line.strip()]
+
+        embeddings = np.zeros((0, 0), dtype=np.float32)
+        if os.path.exists(self.embeddings_path):
+            embeddings = np.load(self.embeddings_path)
+            if embeddings.ndim != 2:
+                raise ValueError("embeddings are not a matrix")
+        return rows, embeddings
+
+    @staticmethod
+    def _row_meta():
+        return {
+            "model": MODEL,
+            "prompt_version": PROMPT_VERSION,
+            "embedding_model": EMBEDDING_MODEL,
+        }
+
+    @classmethod
+    def _parse_row(cls, line):
+        """Returns the parse stored in a meta.jsonl row, or None if the row is
+        unreadable or was made by a different model or prompt version."""
+        try:
+            row = json.loads(line)
+            response = row["response"]
+            if row["meta"] != cls._row_meta():
+                return None
+            if not ExtractionCache.REQUIRED_KEYS <= response.keys():
+                return None
+            return response
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    def _save_embeddings(self):
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(self.embeddings_path), suffix=".tmp", delete=False
+        ) as tmp_file:
+            np.save(tmp_file, self.embeddings)
+        os.replace(tmp_file.name, self.embeddings_path)
+
+    def _rewrite(self):
+        """Rewrites both files from the rows kept in memory."""
+        with tempfile.NamedTemporaryFile(
+            "w",
+            dir=os.path.dirname(self.meta_path),
+            suffix=".tmp",
+            delete=False,
+            encoding="utf-8",
+        ) as tmp_file:
+            for response in self.meta:
+                tmp_file.write(
+                    json.dumps({"meta": self._row_meta(), "response": response}) + "\n"
+                )
+        os.replace(tmp_file.name, self.meta_path)
+        self._save_embeddings()
+
+    @staticmethod
+    def embed(email_texts: List[str]):
+        """Returns the L2-normalized embeddings of the email texts, one row
+        per text, from a single request."""
+        response = openai_client().embeddings.create(
+            model=EMBEDDING_MODEL, input=email_texts
+        )
+        embeddings = np.asarray(
+            [item.embedding for item in sorted(response.data, key=lambda d: d.index)],
+            dtype=np.float32,
+        )
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    def get(self, embedding, email_text: str):
+        """Returns the parse of the most similar cached email if it's similar
+        enough, otherwise None.
+
+        Template variants differ in exactly the name and company, so a parse
+        is only reused if its name and company also appear in this email."""
+        with self.lock:
+            if not self.meta:
+                return None
+
+            similarities = self.embeddings @ embedding
+            index = int(similarities.argmax())
+            if similarities[index] <= self.threshold:
+                return None
+
+            response = self.meta[index]
+            lowered_text = email_text.lower()
+            for value in (response["name"], response["company"]):
+                if value and value.lower() not in lowered_text:
+                    return None
+            return response
+
+    def put(self, embedding, response):
+        """Adds a parse to the cache and persists it."""
+        with self.lock:
+            if self.embeddings.size:
+                self.embeddings = np.vstack([self.embeddings, embedding])
+            else:
+                self.embeddings = embedding.reshape(1, -1)
+            self.meta.append(response)
+
+            with open(self.meta_path, "a", encoding="utf-8") as meta_file:
+                meta_file.write(
+                    json.dumps({"meta": self._row_meta(), "response": response}) + "\n"
+                )
+            self._save_embeddings()
+
+
+class SMTPPool:
+    """Pool of authenticated SMTP sessions, opened lazily and reused across
+    sends so that each send doesn't pay for a TLS handshake and login."""
+
+    IDLE_NOOP_SECS = 60
+
+    def __init__(self, size):
+        self.size = size
+        self._slots = queue.Queue()
+        for _ in range(size):
+            # (session, time last used); sessions are opened on first use
+            self._slots.put((None, 0.0))
+
+    @staticmethod
+    def _connect():
+        smtp = smtplib.SMTP_SSL(os.getenv("SMTP_HOST"), os.getenv("SMTP_PORT"))
+        try:
+            smtp.ehlo()
+            smtp.login(os.getenv("MAILBOX_USER"), os.getenv("MAILBOX_PASS"))
+        except BaseException:
+            smtp.close()
+            raise
+        return smtp
+
+    @staticmethod
+    def _disconnect(smtp):
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    def _try_connect(self):
+        try:
+            return self._connect()
+        except (smtplib.SMTPException, OSError):
+            print("Error opening SMTP session; will retry when it's needed")
+            traceback.print_exc()
+            return None
+
+    def warm(self, count):
+        """Opens sessions for up to count slots concurrently, so the TLS
+        handshakes and logins overlap instead of happening one by one as sends
+        need them. Providers rate-limit logins, so no more are opened than
+        there are emails to send."""
+        count = min(self.size, count)
+        if count < 1:
+            return
+
+        slots = [self._slots.get() for _ in range(count)]
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            sessions = list(
+                executor.map(lambda slot: slot[0] or self._try_connect(), slots)
+            )
+        for smtp in sessions:
+            self._slots.put((smtp, time.monotonic()))
+
+    @contextlib.contextmanager
+    def acquire(self):
+        """Checks out a connected session, reconnecting the slot if its
+        session was dropped or has gone stale while idle."""
+        smtp, last_used = self._slots.get()
+        try:
+            if smtp is not None and time.monotonic() - last_used > self.IDLE_NOOP_SECS:
+                try:
+                    alive = smtp.noop()[0] == 250
+                except (smtplib.SMTPException, OSError):
+                    alive = False
+                if not alive:
+                    self._disconnect(smtp)
+                    smtp = None
+
+            if smtp is None:
+                smtp = self._connect()
+
+            yield smtp
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException):
+            if smtp is not None:
+                self._disconnect(smtp)
+                smtp = None
+            raise
+        finally:
+            self._slots.put((smtp, time.monotonic()))
+
+    def close(self):
+        """Closes all open sessions."""
+        while True:
+            try:
+                smtp, _ = self._slots.get_nowait()
+            except queue.Empty:
+                break
+            if smtp is not None:
+                self._disconnect(smtp)
 
 
 class Mailer:
-    """Handles interfacing with the IMAP and SMTP email clients."""
+    """Handles interfacing with the IMAP and SMTP email clients.
+
+    The IMAP client isn't thread-safe, so it's guarded by a lock; SMTP
+    sends each check out a session from a pool."""
 
     def __init__(self):
+        self._imap_lock = threading.Lock()
+        self._done_lock = threading.Lock()
+        self._done_uids = []
+        # previews from concurrent sends are printed whole, one at a time
+        self._preview_lock = threading.Lock()
+        # set to stop sends that are still in their grace period
+        self.cancelled = threading.Event()
+
         self.imap_mailbox = MailBox(
             os.getenv("IMAP_HOST"), os.getenv("IMAP_PORT")
         ).login(os.getenv("MAILBOX_USER"), os.getenv("MAILBOX_PASS"))
 
-        self.smtp_mailbox = smtplib.SMTP_SSL(
-            os.getenv("SMTP_HOST"), os.getenv("SMTP_PORT")
-        )
-
-        self.smtp_mailbox.ehlo()
-        self.smtp_mailbox.login(os.getenv("MAILBOX_USER"), os.getenv("MAILBOX_PASS"))
+        self.smtp_pool = SMTPPool(WORKERS)
+
+        # saving to the Sent folder is another IMAP round-trip, so it happens
+        # on a background thread rather than holding up the send
+        self._append_queue = queue.Queue()
+        threading.Thread(target=self._append_worker, daemon=True).start()
+
+    def _append_worker(self):
+        while True:
+            message, folder = self._append_queue.get()
+            try:
+                with self._imap_lock:
+                    self.imap_mailbox.append(
+                        message.as_bytes(),
+                        folder,
+                        dt=None,
+                        flag_set=[MailMessageFlags.SEEN],
+                    )
+            except Exception:
+                print("Error saving sent email to the Sent folder!")
+                traceback.print_exc()
+            finally:
+                self._append_queue.task_done()
 
     def save_to_sent_folder(self, message):
-        """Saves a sent message to the Sent folder."""
-        self.imap_mailbox.append(
-            str.encode(message.as_string()),
-            os.getenv("MAILBOX_SENT_FOLDER"),
-            dt=None,
-            flag_set=[MailMessageFlags.SEEN],
-        )
+        """Queues a sent message to be saved to the Sent folder."""
+        self._append_queue.put((message, MAILBOX_SENT_FOLDER))
 
     def compose_and_send_mail(self, subject, in_reply_to, from_addr, to_addrs, body):
-        """Builds email and sends it over SMTP."""
+        """Builds email and sends it over SMTP. Returns whether it was sent."""
 
-        message = MIMEMultipart()
+        # replies are plain text with no attachments, so skip multipart
+        message = EmailMessage()
 
         message["From"] = from_addr
         message["To"] = ", ".join(to_addrs)
-        message["Subject"] = subject
-        message["In-Reply-To"] = in_reply_to
-
-        message.attach(MIMEText(body))
-
-        print("Generated response email:")
-        print(message.as_string(), flush=True)
-        print(f"Going to send this email in {GRACE_PERIOD_SECS} seconds...")
+        # headers read from the original message may still be folded, which
+        # the default policy rejects as a header injection
+        message["Subject"] = " ".join(subject.split())
+        message["In-Reply-To"] = in_reply_to.strip()
+
+        message.set_content(body)
+
+        with self._preview_lock:
+            print("Generated response email:")
+            print(message.as_string())
+            print(
+                f"Going to send this email in {GRACE_PERIOD_SECS} seconds...",
+                flush=True,
+            )
 
         if not DRY_RUN:
-            time.sleep(GRACE_PERIOD_SECS)
+            # wakes up early if the run is cancelled during the grace period
+            self.cancelled.wait(GRACE_PERIOD_SECS)
+
+        if self.cancelled.is_set():
+            print(f"Cancelled; not sending email to {message['To']}")
+            return False
 
         if not DRY_RUN:
-            self.smtp_mailbox.sendmail(
-                from_addr,
-                to_addrs,
-                message.as_string(),
-            )
+            with self.smtp_pool.acquire() as smtp:
+                smtp.send_message(message, from_addr, to_addrs)
             self.save_to_sent_folder(message)
             print("Sent email")
-        else:
-            print("DRY_RUN; not sending email")
+            return True
+
+        print("DRY_RUN; not sending email")
+        return False
 
     def _is_reply(self, mail_message: MailMessage):
         return "in-reply-to" in [header.lower() for header in mail_message.headers]
 
-    def get_recruiter_emails(self):
-        """Gets all unprocessed recruiter emails from the Recruitment folder."""
-        self.imap_mailbox.folder.set(os.getenv("MAILBOX_RECRUITMENT_FOLDER"))
-        all_recruiter_emails = list(self.imap_mailbox.fetch())
+    def _non_reply_uids(self):
+        """Gets the UIDs of messages in the current folder that aren't replies,
+        without downloading any message bodies."""
+        try:
+            # an empty HEADER value matches any message that has the header
+            return self.imap_mailbox.uids(NOT(header=H("In-Reply-To", "")))
+        except MailboxUidsError:
+            print("Server rejected the In-Reply-To search; triaging on headers")
+            return [
+                mail_message.uid
+                for mail_message in self.imap_mailbox.fetch(
+                    headers_only=True, bulk=IMAP_BULK, mark_seen=False
+                )
+                if not self._is_reply(mail_message)
+            ]
+
+    @staticmethod
+    def _build_mail_messages(fetch_data):
+        """Reassembles messages from a FETCH of RECRUITER_EMAIL_FETCH_PARTS, whose
+        response has separate literals for the headers and the body."""
+        parts = []
+        current = None
+        for fetch_item in fetch_data:
+            if isinstance(fetch_item, tuple):
+                preamble, literal = fetch_item
+                if FETCH_RESPONSE_START_RE.match(preamble):
+                    current = {"preamble": b"", "header": b"", "text": b""}
+                    parts.append(current)
+                if current is None:
+                    continue
+                current["preamble"] += preamble
+                is_text = preamble.rsplit(b"BODY[", 1)[-1].startswith(b"TEXT]")
+                current["text" if is_text else "header"] = literal
+            elif isinstance(fetch_item, bytes):
+                if FETCH_RESPONSE_START_RE.match(fetch_item):
+                    # a response without literals, e.g. an unsolicited FLAGS
+                    # update, which isn't part of any message fetched here
+                    current = None
+                elif current is not None:
+                    # trailing data, e.g. b")", b" UID 42)" or b' BODY[TEXT] "")'
+                    current["preamble"] += fetch_item
+
+        return [
+            MailMessage([(part["preamble"], part["header"] + part["text"])])
+            for part in parts
+        ]
 
-        filtered_messages = []
-        for mail_message in all_recruiter_emails:
-            if not self._is_reply(mail_message):
-                filtered_messages.append(mail_message)
+    def _fetch_recruiter_emails(self, uids):
+        """Fetches messages in bulk, without the headers and parts that
+        RECRUITER_EMAIL_FETCH_PARTS leaves out."""
+        for start in range(0, len(uids), IMAP_BULK):
+            fetch_result = self.imap_mailbox.client.uid(
+                "FETCH",
+                ",".join(uids[start : start + IMAP_BULK]),
+                RECRUITER_EMAIL_FETCH_PARTS,
+            )
+            check_command_status(fetch_result, MailboxFetchError)
+            yield from self._build_mail_messages(fetch_result[1])
 
-        return filtered_messages
+    def get_recruiter_emails(self):
+        """Yields all unprocessed recruiter emails from the Recruitment folder
+        as they're fetched."""
+        with self._imap_lock:
+            self.imap_mailbox.folder.set(MAILBOX_RECRUITMENT_FOLDER)
+            uids = self._non_reply_uids()
+
+        if not uids:
+            return
+
+        # FETCHes are batched rather than one per round-trip, and PEEK leaves
+        # \Seen alone since unsent emails are retried on the next run
+        mail_messages = self._fetch_recruiter_emails(uids)
+        while True:
+            # the next batch is fetched on the shared connection, so hold the
+            # lock only while advancing the generator
+            with self._imap_lock:
+                mail_message = next(mail_messages, None)
+            if mail_message is None:
+                return
+            yield mail_message
 
     def move_to_done(self, email):
-        """After processing a message, used to move message to Done folder."""
-        self.imap_mailbox.move(email.uid, os.getenv("MAILBOX_DONE_FOLDER"))
+        """After processing a message, used to move message to Done folder.
+        Moves are batched, IMAP_BULK messages at a time."""
+        with self._done_lock:
+            self._done_uids.append(email.uid)
+            should_flush = len(self._done_uids) >= IMAP_BULK
+
+        if should_flush:
+            self.flush_moves()
+
+    def flush_moves(self):
+        """Moves all processed messages to the Done folder with one command."""
+        with self._done_lock:
+            uids, self._done_uids = self._done_uids, []
+
+        if not uids:
+            return
+
+        try:
+            with self._imap_lock:
+                self.imap_mailbox.move(uids, MAILBOX_DONE_FOLDER)
+        except Exception:
+            # keep them so that a later flush can retry the move
+            with self._done_lock:
+                self._done_uids[:0] = uids
+            raise
 
     def cleanup(self):
-        """Cleans up mailbox client(s)."""
-        self.smtp_mailbox.quit()
-
-
-def send_response(mailer: Mailer, recruiter_email: MailMessage):
-    """Given an email from a recruiter, sends a courtesy response."""
-
-    quoted_original = ""
-
-    for line in recruiter_email.text.splitlines():
-        quoted_original += f"> {line}\n"
+        """Cleans up mailbox client(s), once pending moves and queued Sent
+        folder saves finish."""
+        try:
+            self.flush_moves()
+        finally:
+            # the writer is a daemon thread, so anything still queued would be
+            # lost at exit; these emails were already delivered
+            try:
+                self._append_queue.join()
+            finally:
+                self.smtp_pool.close()
+
+
+def send_response(mailer: Mailer, recruiter_email: MailMessage, name_and_co: dict):
+    """Given an email from a recruiter and their parsed name and company,
+    sends a courtesy response."""
+
+    quoted_original = "".join(
+        f"> {line}\n" for line in recruiter_email.text.splitlines()
+    )
 
     try:
-        name_and_co = get_recruiter_name_and_company(recruiter_email.text)
         recruiter_name = name_and_co["name"]
         recruiter_company = name_and_co["company"]
-        response = f"""\
-        Hi {recruiter_name or ""},
-
-        Thanks for reaching out! I'm not interested in new opportunities at this time, but I'll keep {recruiter_company or "your company"} in mind for the future.
-
-
-        Thanks again,
-        {SIGNATURE}
-
-        """
+        response = RESPONSE_TEMPLATE.format(
+            name=recruiter_name or "",
+            company=recruiter_company or "your company",
+            signature=SIGNATURE,
+        )
 
-        response_body = textwrap.dedent(response) + quoted_original
+        response_body = response + quoted_original
 
-        mailer.compose_and_send_mail(
+        sent = mailer.compose_and_send_mail(
             subject=f"Re:{recruiter_email.subject}",
             in_reply_to=recruiter_email.headers["message-id"][0],
-            from_addr=os.getenv("EMAIL_ADDRESS"),
+            from_addr=EMAIL_ADDRESS,
             to_addrs=[recruiter_email.from_],
             body=response_body,
         )
 
-        if not DRY_RUN:
+        if sent:
             mailer.move_to_done(recruiter_email)
 
     except Exception:
@@ -149,75 +773,368 @@ def send_response(mailer: Mailer, recruiter_email: MailMessage):
         print(recruiter_email.text)
 
 
-def respond_to_recruitment_emails(mailer: Mailer):
+def prefetch(iterable, size):
+    """Yields from iterable while a background thread keeps up to size items
+    fetched ahead, so producing the next item overlaps with using this one."""
+    buffered = queue.Queue(maxsize=size)
+    end = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                buffered.put((item, None))
+            buffered.put((end, None))
+        except Exception as exception:
+            buffered.put((end, exception))
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    while True:
+        item, exception = buffered.get()
+        if exception is not None:
+            raise exception
+        if item is end:
+            return
+        yield item
+
+
+def respond_to_recruitment_emails(
+    mailer: Mailer, extraction_cache: ExtractionCache, semantic_cache: SemanticCache
+):
     """Reads recruiter emails in the MAILBOX_RECRUITMENT_FOLDER, responds to
     them, then moves each conversation to the MAILBOX_DONE_FOLDER so that
     it's not repeatedly processed."""
 
-    emails = mailer.get_recruiter_emails()
-
-    print(f"Going to respond to {len(emails)} emails")
-
-    for index, email in enumerate(emails):
-        print(f"Responding to email {index + 1} of {len(emails)}...")
-        send_response(mailer, email)
-        print("Done")
-        print(
-            "--------------------------------------------------------------------------------"
-        )
+    # fetch the next batch from the server while this one is parsed
+    emails = prefetch(mailer.get_recruiter_emails(), EXTRACTION_BATCH_SIZE)
+    email_count = 0
+    # bounds how far fetching and parsing can run ahead of sending
+    pending_sends = threading.BoundedSemaphore(2 * WORKERS)
+
+    def respond(index, email, name_and_co):
+        try:
+            print(f"Responding to email {index + 1}...")
+            send_response(mailer, email, name_and_co)
+            print(f"Done with email {index + 1}")
+            print(
+                "--------------------------------------------------------------------------------"
+            )
+        finally:
+            pending_sends.release()
+
+    # Emails are streamed from the server and parsed a batch at a time so one
+    # OpenAI request covers several of them, while the sends for a batch
+    # overlap with fetching and parsing the next.
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        try:
+            while True:
+                batch = list(itertools.islice(emails, EXTRACTION_BATCH_SIZE))
+                if not batch:
+                    break
+
+                if email_count == 0 and not DRY_RUN:
+                    # connect to the SMTP server while the first batch is being parsed
+                    executor.submit(mailer.smtp_pool.warm, len(batch))
+
+                start = email_count
+                email_count += len(batch)
+
+                try:
+                    names_and_cos = get_recruiter_names_and_companies(
+                        batch, extraction_cache, semantic_cache
+                    )
+                except Exception:
+                    print("Error parsing recruiter names and companies! Skipping batch")
+                    traceback.print_exc()
+                    continue
+
+                for index, (email, name_and_co) in enumerate(
+                    zip(batch, names_and_cos), start
+                ):
+                    if name_and_co is None:
+                        print(f"Couldn't parse email {index + 1}! Skipping")
+                        print("Recruiter email:")
+                        print(email.text)
+                        continue
+
+                    pending_sends.acquire()
+                    executor.submit(respond, index, email, name_and_co)
+
+                # move what's been answered so far, so an interrupted run doesn't
+                # leave answered emails behind to be replied to again
+                try:
+                    mailer.flush_moves()
+                except Exception:
+                    print("Error moving emails to the Done folder! Will retry")
+                    traceback.print_exc()
+        except KeyboardInterrupt:
+            # Workers only check for cancellation after their grace period, and
+            # leaving the with block would otherwise run every queued send.
+            print("Interrupted! Cancelling emails that haven't been sent")
+            mailer.cancelled.set()
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    print(f"Processed {email_count} emails")
+
+
+def email_snippet(email_text: str):
+    """Trims quoted thread history and caps the length of an email so only
+    the part likely to mention the recruiter is sent to OpenAI."""
+    match = QUOTED_HISTORY_RE.search(email_text)
+    if match and email_text[: match.start()].strip():
+        email_text = email_text[: match.start()]
+    return email_text[:MAX_PROMPT_EMAIL_CHARS]
+
+
+def first_name(display_name: str):
+    """Returns the first name from a display name like "Jane Doe" or
+    "Doe, Jane", or None if there isn't one or the name belongs to a team
+    or a system rather than a person."""
+    name_words = {word.lower() for word in re.findall(r"\w+", display_name)}
+    if name_words & GENERIC_SENDER_NAME_WORDS:
+        return None
+
+    display_name_parts = [
+        part
+        for part in display_name.split(",")[-1].split()
+        if part.rstrip(".").lower() not in HONORIFICS
+    ]
+    return display_name_parts[0] if display_name_parts else None
+
+
+def sender_extract(sender: Optional[EmailAddress]):
+    """Takes the recruiter's name from the sender's display name and their
+    company from the sender's mail domain, e.g. "Jane Doe" <jane@acme.com>.
+    Returns None if either looks generic."""
+    if sender is None or not sender.name or "@" not in sender.email:
+        return None
+
+    # a bare "Jane" is as likely to be a team or product name as a person
+    if len(re.findall(r"\w+", sender.name)) < 2:
+        return None
+
+    # ignore subdomains and second-level suffixes like the "co" in acme.co.uk
+    domain_labels = sender.email.rsplit("@", 1)[1].lower().split(".")
+    if len(domain_labels) < 2:
+        return None
+    company_label = domain_labels[-2]
+    if (
+        len(domain_labels) > 2
+        and len(domain_labels[-1]) == 2
+        and company_label in SECOND_LEVEL_DOMAINS
+    ):
+        company_label = domain_labels[-3]
+    if company_label in GENERIC_EMAIL_DOMAINS:
+        return None
+
+    name = first_name(sender.name)
+    company = company_label.replace("-", " ").title()
+    # e.g. "Acme Careers" <jobs@acme.com> isn't signed by a person
+    if name and name.lower() in (company_label, company.lower()):
+        return None
+    if name and company:
+        return {"name": name, "company": company}
+    return None
+
+
+def company_name(words: str):
+    """Cuts a run of capitalized words after "at"/"with" off at the end of
+    its sentence, e.g. "Acme. I" -> "Acme", keeping suffixes like "Inc."."""
+    company_words = []
+    for word in words.split():
+        company_words.append(word)
+        if word.endswith("."):
+            break
+
+    if company_words[-1] not in COMPANY_SUFFIXES:
+        company_words[-1] = company_words[-1].rstrip(".")
+    return " ".join(company_words) or None
+
+
+def heuristic_extract(email_text: str):
+    """Pulls the recruiter's name and company out of a self-introduction like
+    "This is Steve with Apple". The company has to come from the same
+    sentence; anything looser is left to OpenAI. Returns None unless both
+    are found."""
+    name_match = next(
+        (
+            name_match
+            for name_match in RECRUITER_NAME_RE.finditer(email_text)
+            if name_match.group(1) not in NAME_STOPWORDS
+        ),
+        None,
+    )
+    if name_match is None:
+        return None
+
+    company_match = RECRUITER_COMPANY_RE.search(email_text, name_match.end())
+    if company_match is None or SENTENCE_END_RE.search(
+        email_text, name_match.end(), company_match.start()
+    ):
+        return None
+
+    company = company_name(company_match.group(1))
+    if company is None:
+        return None
+    return {"name": name_match.group(1), "company": company}
+
+
+def get_recruiter_names_and_companies(
+    recruiter_emails: List[MailMessage],
+    extraction_cache: ExtractionCache,
+    semantic_cache: SemanticCache,
+):
+    """Parses each recruiter's name and company from their email, using simple
+    heuristics or cached parses where possible and a single request to OpenAI
+    text models for the rest. Emails that couldn't be parsed get None."""
+
+    results = [None] * len(recruiter_emails)
+    uncached = []
+
+    for index, recruiter_email in enumerate(recruiter_emails):
+        sender = recruiter_email.from_values
+        from_sender = sender_extract(sender)
+        if from_sender is not None:
+            print("Took recruiter name and company from the sender's address")
+            results[index] = from_sender
+            continue
+
+        snippet = email_snippet(recruiter_email.text)
+
+        heuristic = heuristic_extract(snippet)
+        if heuristic is not None:
+            print("Extracted recruiter name and company heuristically")
+            results[index] = heuristic
+            continue
+
+        # consider disabling expensive OpenAI calls in development if not relevant
+        if BYPASS_OPENAI:
+            print("Bypassing OpenAI API, mocking data")
+            results[index] = json.loads('{"name": "Steve", "company": "Apple"}')
+            continue
+
+        cache_key = ExtractionCache.key(MODEL, PROMPT_VERSION, snippet)
+        cached = extraction_cache.get(cache_key)
+        if cached is not None:
+            print("Using cached recruiter name and company")
+            results[index] = cached
+            continue
+
+        uncached.append((index, snippet, cache_key))
+
+    if not uncached:
+        return results
+
+    # Failures from here on only affect the emails that needed OpenAI; the
+    # ones already resolved above are still returned.
+    try:
+        embeddings = SemanticCache.embed([snippet for _, snippet, _ in uncached])
+    except Exception:
+        print("Error embedding recruiter emails! Skipping the semantic cache")
+        traceback.print_exc()
+        embeddings = [None] * len(uncached)
 
+    unparsed = []
+    for (index, snippet, cache_key), embedding in zip(uncached, embeddings):
+        similar = None
+        if embedding is not None:
+            similar = semantic_cache.get(embedding, snippet)
+        if similar is not None:
+            print("Using recruiter name and company cached for a similar email")
+            extraction_cache.put(cache_key, similar)
+            results[index] = similar
+            continue
 
-def get_recruiter_name_and_company(email_text: str):
-    """Uses OpenAI text models to automatically parse the recruiter's name
-    and company from their email."""
+        unparsed.append((index, snippet, cache_key, embedding))
 
-    prompt = f"""
-    Given an email from a recruiter, return the recruiter's first name and the recruiter's company's name formatted as valid JSON.
+    if not unparsed:
+        return results
 
-    Example: ***
-    Email:
-    '''
-    Hi Matt! This is Steve Jobs with Apple Computer Company! I'm interested in having you join our team here.
-    '''
+    try:
+        parsed = complete_names_and_companies(
+            [snippet for _, snippet, _, _ in unparsed]
+        )
+    except Exception:
+        print("Error parsing recruiter names and companies with OpenAI!")
+        traceback.print_exc()
+        return results
 
-    Response:
-    {{"name": "Steve", "company": "Apple Computer Company"}}
-    ***
+    for (index, _, cache_key, embedding), name_and_co in zip(unparsed, parsed):
+        extraction_cache.put(cache_key, name_and_co)
+        if embedding is not None:
+            semantic_cache.put(embedding, name_and_co)
+        results[index] = name_and_co
 
-    Email:
-    '''
-    {email_text}
+    return results
 
-    '''
 
-    Response:
-    """
+def complete_names_and_companies(snippets: List[str]):
+    """Asks OpenAI for the recruiter's name and company in each of several
+    emails at once, returning the parses in the same order."""
 
-    # consider disabling expensive OpenAI calls in development if not relevant
-    if BYPASS_OPENAI:
-        print("Bypassing OpenAI API, mocking data")
-        return json.loads('{"name": "Steve", "company": "Apple"}')
-
-    completion = openai.Completion.create(
-        model="text-davinci-002",
-        prompt=textwrap.dedent(prompt),
-        max_tokens=20,
-        temperature=0,
+    prompt = EXTRACTION_PROMPT_TEMPLATE.format(
+        emails="".join(
+            f"Email [{number}]:\n'''\n{snippet}\n'''\n\n"
+            for number, snippet in enumerate(snippets, 1)
+        )
     )
 
-    try:
-        # If we end up needing more cleaning to ensure the response can be parsed,
-        # consider improving the prompt.
-        json_str_response = completion.choices[0].text
-        json_str_response_clean = re.search(r".*(\{.*\})", json_str_response).groups()[
-            0
-        ]
+    messages = [{"role": "user", "content": prompt}]
+
+    # The schema is enforced by the API, so a bad response is rare; when one
+    # does come back, retry with feedback rather than trying to clean it up.
+    max_tokens = 20 + 30 * len(snippets)
+    for attempt in range(MAX_EXTRACTION_RETRIES + 1):
+        completion = openai_client().chat.completions.create(
+            model=MODEL,
+            messages=messages,
+            # the schema ends generation once the JSON object closes, so no
+            # stop sequence is needed to cut off trailing text
+            response_format={
+                "type": "json_schema",
+                "json_schema": NAMES_AND_COMPANIES_SCHEMA,
+            },
+            max_tokens=max_tokens,
+            temperature=0,
+        )
 
-        return json.loads(json_str_response_clean)
-    except (AttributeError, json.decoder.JSONDecodeError) as exception:
-        print("Could not decode completion response from OpenAI:")
-        print(completion)
-        raise exception
+        # a response cut off at the token limit would be cut off again by an
+        # unchanged retry, so give the next attempt more room instead
+        if completion.choices[0].finish_reason == "length":
+            print(f"OpenAI response was cut off at {max_tokens} tokens")
+            if attempt == MAX_EXTRACTION_RETRIES:
+                raise ValueError(f"response exceeded {max_tokens} tokens")
+            max_tokens *= 2
+            continue
+
+        response_content = completion.choices[0].message.content
+
+        try:
+            by_number = {
+                result["email"]: {"name": result["name"], "company": result["company"]}
+                for result in json.loads(response_content)["results"]
+            }
+            if set(by_number) != set(range(1, len(snippets) + 1)):
+                raise ValueError(
+                    f"expected one result for each of emails 1 to {len(snippets)}"
+                )
+            return [by_number[number] for number in range(1, len(snippets) + 1)]
+        except (KeyError, TypeError, ValueError) as exception:
+            print("Could not decode completion response from OpenAI:")
+            print(completion)
+            if attempt == MAX_EXTRACTION_RETRIES:
+                raise exception
+
+            messages = messages + [
+                {"role": "assistant", "content": response_content or ""},
+                {
+                    "role": "user",
+                    "content": f"That response was invalid ({exception}). "
+                    "Respond with only the JSON object.",
+                },
+            ]
+            time.sleep(attempt + 1)
 
 
 def main():
@@ -235,14 +1152,16 @@ def main():
     if BYPASS_OPENAI:
         print("BYPASS_OPENAI mode on")
 
-    openai.organization = os.getenv("OPENAI_ORG")
-    openai.api_key = os.getenv("OPENAI_SECRET_KEY")
-
+    # built here rather than on import so that importing the module doesn't
+    # touch the cache directory
+    extraction_cache = ExtractionCache(CACHE_DIR)
+    semantic_cache = SemanticCache(CACHE_DIR, SEMANTIC_CACHE_THRESHOLD)
     mailer = Mailer()
 
-    respond_to_recruitment_emails(mailer)
-
-    mailer.cleanup()
+    try:
+        respond_to_recruitment_emails(mailer, extraction_cache, semantic_cache)
+    finally:
+        mailer.cleanup()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,259 @@
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import unittest
+
+from unittest import mock
+
+import numpy as np
+
+from imap_tools import EmailAddress
+
+import recruiter_rm
+
+
+class HeuristicExtractTest(unittest.TestCase):
+    def test_name_and_company(self):
+        self.assertEqual(
+            recruiter_rm.heuristic_extract(
+                "Hi Matt! This is Steve Jobs with Apple Computer Company! I'm"
+            ),
+            {"name": "Steve", "company": "Apple Computer Company"},
+        )
+
+    def test_company_stops_at_end_of_sentence(self):
+        for text, company in [
+            ("My name is Jane, a recruiter at Acme. I came across", "Acme"),
+            ("This is Jane from Google. Would you be open", "Google"),
+            ("This is Jane with Apple Inc. We are hiring", "Apple Inc."),
+            ("This is Jane with Acme Corp! We are hiring", "Acme Corp"),
+        ]:
+            with self.subTest(text=text):
+                self.assertEqual(
+                    recruiter_rm.heuristic_extract(text)["company"], company
+                )
+
+    def test_name_skips_stopwords(self):
+        self.assertIsNone(
+            recruiter_rm.heuristic_extract("I'm Excited to share a role at Acme.")
+        )
+        self.assertEqual(
+            recruiter_rm.heuristic_extract(
+                "I'm Excited to share this. I'm Jane, with Acme."
+            ),
+            {"name": "Jane", "company": "Acme"},
+        )
+
+    def test_company_must_be_in_introduction_sentence(self):
+        self.assertEqual(
+            recruiter_rm.heuristic_extract(
+                "I loved your work at Stripe. I'm Jane from Acme."
+            ),
+            {"name": "Jane", "company": "Acme"},
+        )
+        for text in [
+            "This is Acme's talent team reaching out from Berlin.",
+            "I'm Jane. Are you free at Noon?",
+            "We're hiring at Stripe.",
+        ]:
+            with self.subTest(text=text):
+                self.assertIsNone(recruiter_rm.heuristic_extract(text))
+
+
+class SenderExtractTest(unittest.TestCase):
+    def test_display_name_and_domain(self):
+        for name, email, expected in [
+            ("Jane Doe", "jane@acme.com", {"name": "Jane", "company": "Acme"}),
+            ("Doe, Jane", "j@mail.acme.co.uk", {"name": "Jane", "company": "Acme"}),
+            ("Jane Doe", "j@big-corp.io", {"name": "Jane", "company": "Big Corp"}),
+            ("Jane Doe", "jane@careers.bmw.de", {"name": "Jane", "company": "Bmw"}),
+            ("Jane Doe", "jane@hr.sap.de", {"name": "Jane", "company": "Sap"}),
+            ("Dr. Jane Doe", "jane@acme.com", {"name": "Jane", "company": "Acme"}),
+            ("Mr Jane", "jane@acme.com", {"name": "Jane", "company": "Acme"}),
+        ]:
+            with self.subTest(email=email):
+                self.assertEqual(
+                    recruiter_rm.sender_extract(EmailAddress(name, email)), expected
+                )
+
+    def test_generic_senders(self):
+        for name, email in [
+            ("Jane Doe", "jane@gmail.com"),
+            ("Jane Doe", "jane@hire.lever.co"),
+            ("Jane", "jane@acme.com"),
+            ("No Reply", "noreply@acme.com"),
+            ("Acme Talent Team", "talent@acme.com"),
+            ("Acme Recruitment", "jobs@acme.com"),
+            ("Acme Hiring", "jobs@acme.com"),
+            ("Acme Corp", "hello@acme.com"),
+        ]:
+            with self.subTest(name=name, email=email):
+                self.assertIsNone(
+                    recruiter_rm.sender_extract(EmailAddress(name, email))
+                )
+
+
+class CompleteNamesAndCompaniesTest(unittest.TestCase):
+    @staticmethod
+    def completion(content, finish_reason):
+        return mock.Mock(
+            choices=[
+                mock.Mock(
+                    finish_reason=finish_reason, message=mock.Mock(content=content)
+                )
+            ]
+        )
+
+    def test_truncated_response_retries_with_larger_budget(self):
+        client = mock.Mock()
+        client.chat.completions.create.side_effect = [
+            self.completion('{"results": [{"email": 1, "na', "length"),
+            self.completion(
+                '{"results": [{"email": 1, "name": "Jane", "company": "Acme"}]}',
+                "stop",
+            ),
+        ]
+
+        with mock.patch.object(recruiter_rm, "openai_client", return_value=client):
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = recruiter_rm.complete_names_and_companies(["Hi"])
+
+        self.assertEqual(results, [{"name": "Jane", "company": "Acme"}])
+        first_call, second_call = client.chat.completions.create.call_args_list
+        self.assertEqual(
+            second_call.kwargs["max_tokens"], 2 * first_call.kwargs["max_tokens"]
+        )
+        self.assertEqual(second_call.kwargs["messages"], first_call.kwargs["messages"])
+
+
+class BuildMailMessagesTest(unittest.TestCase):
+    HEADER = b"From: Jane Doe <jane@acme.com>\r\nSubject: Hello\r\n\r\n"
+
+    def test_literals_in_either_order(self):
+        fetch_data = [
+            (b"1 (UID 42 BODY[HEADER.FIELDS (FROM SUBJECT)] {50}", self.HEADER),
+            (b" BODY[TEXT] {5}", b"Hi!\r\n"),
+            b")",
+            (b"2 (UID 43 BODY[TEXT] {5}", b"Yo!\r\n"),
+            (b" BODY[HEADER.FIELDS (FROM SUBJECT)] {50}", self.HEADER),
+            b")",
+        ]
+
+        messages = recruiter_rm.Mailer._build_mail_messages(fetch_data)
+
+        self.assertEqual([message.uid for message in messages], ["42", "43"])
+        self.assertEqual([message.subject for message in messages], ["Hello", "Hello"])
+        self.assertEqual([message.text for message in messages], ["Hi!\r\n", "Yo!\r\n"])
+
+    def test_trailing_uid(self):
+        fetch_data = [
+            (b"1 (BODY[HEADER.FIELDS (FROM SUBJECT)] {50}", self.HEADER),
+            (b" BODY[TEXT] {5}", b"Hi!\r\n"),
+            b" UID 43)",
+        ]
+
+        (message,) = recruiter_rm.Mailer._build_mail_messages(fetch_data)
+
+        self.assertEqual(message.uid, "43")
+        self.assertEqual(message.text, "Hi!\r\n")
+
+    def test_quoted_empty_body(self):
+        fetch_data = [
+            (b"1 (UID 42 BODY[HEADER.FIELDS (FROM SUBJECT)] {50}", self.HEADER),
+            b' BODY[TEXT] "")',
+        ]
+
+        (message,) = recruiter_rm.Mailer._build_mail_messages(fetch_data)
+
+        self.assertEqual(message.uid, "42")
+        self.assertEqual(message.from_, "jane@acme.com")
+        self.assertEqual(message.text, "")
+
+    def test_unsolicited_fetch_between_messages(self):
+        fetch_data = [
+            (b"1 (BODY[HEADER.FIELDS (FROM SUBJECT)] {50}", self.HEADER),
+            (b" BODY[TEXT] {5}", b"Hi!\r\n"),
+            b" UID 42)",
+            b"5 (FLAGS (\\Seen) UID 99)",
+            (b"2 (UID 43 BODY[HEADER.FIELDS (FROM SUBJECT)] {50}", self.HEADER),
+            (b" BODY[TEXT] {5}", b"Yo!\r\n"),
+            b")",
+        ]
+
+        messages = recruiter_rm.Mailer._build_mail_messages(fetch_data)
+
+        self.assertEqual([message.uid for message in messages], ["42", "43"])
+        self.assertEqual([message.text for message in messages], ["Hi!\r\n", "Yo!\r\n"])
+
+
+class ComposeAndSendMailTest(unittest.TestCase):
+    def test_folded_headers(self):
+        mailer = recruiter_rm.Mailer.__new__(recruiter_rm.Mailer)
+        mailer._preview_lock = threading.Lock()
+        mailer.cancelled = threading.Event()
+        output = io.StringIO()
+
+        with mock.patch.object(recruiter_rm, "DRY_RUN", True):
+            with contextlib.redirect_stdout(output):
+                sent = mailer.compose_and_send_mail(
+                    subject="Re:A very long subject line that is\r\n folded onto two lines",
+                    in_reply_to="\r\n <abc123@acme.com>",
+                    from_addr="me@example.com",
+                    to_addrs=["jane@acme.com"],
+                    body="Thanks!",
+                )
+
+        self.assertFalse(sent)
+        self.assertIn(
+            "Subject: Re:A very long subject line that is folded onto two lines",
+            output.getvalue(),
+        )
+        self.assertIn("In-Reply-To: <abc123@acme.com>", output.getvalue())
+
+
+class SemanticCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.embedding = np.array([0.6, 0.8], dtype=np.float32)
+        cache = recruiter_rm.SemanticCache(self.cache_dir, 0.95)
+        cache.put(self.embedding, {"name": "Jane", "company": "Acme"})
+
+    def test_hit_requires_name_and_company_in_email(self):
+        cache = recruiter_rm.SemanticCache(self.cache_dir, 0.95)
+        self.assertEqual(
+            cache.get(self.embedding, "Hi, this is Jane from Acme"),
+            {"name": "Jane", "company": "Acme"},
+        )
+        self.assertIsNone(cache.get(self.embedding, "Hi, this is Bob from Acme"))
+        self.assertIsNone(
+            cache.get(np.array([1.0, 0.0], dtype=np.float32), "Jane from Acme")
+        )
+
+    def test_drops_stale_rows(self):
+        with mock.patch.object(recruiter_rm, "PROMPT_VERSION", "stale"):
+            cache = recruiter_rm.SemanticCache(self.cache_dir, 0.95)
+            self.assertIsNone(cache.get(self.embedding, "Jane from Acme"))
+            cache.put(self.embedding, {"name": "Bob", "company": "Initech"})
+
+        cache = recruiter_rm.SemanticCache(self.cache_dir, 0.95)
+        self.assertEqual(cache.meta, [])
+        self.assertEqual(len(cache.embeddings), 0)
+
+    def test_unreadable_embeddings_start_empty(self):
+        with open(os.path.join(self.cache_dir, "embeddings.npy"), "wb") as npy_file:
+            npy_file.write(b"not a numpy file")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            cache = recruiter_rm.SemanticCache(self.cache_dir, 0.95)
+        self.assertEqual(cache.meta, [])
+        self.assertIsNone(cache.get(self.embedding, "Jane from Acme"))
+
+        cache.put(self.embedding, {"name": "Jane", "company": "Acme"})
+        cache = recruiter_rm.SemanticCache(self.cache_dir, 0.95)
+        self.assertEqual(cache.meta, [{"name": "Jane", "company": "Acme"}])
+
+
+if __name__ == "__main__":
+    unittest.main()